@@ -3,15 +3,23 @@
 Fare watcher: BER → Anywhere, one-way under a price cap.
 """
 
-import os, sys, json, time, ssl, smtplib
+import os, sys, time, ssl, smtplib, sqlite3, threading, functools, itertools
 import datetime as dt
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from pathlib import Path
+import orjson
 import requests
 from requests.adapters import HTTPAdapter, Retry
 
 AMADEUS_BASE = os.getenv("AMADEUS_BASE", "https://api.amadeus.com")
-STATE_FILE = Path("state.json")
+STATE_DB = Path("state.db")
+LEGACY_STATE_FILE = Path("state.json")
+OFFER_CACHE_FILE = Path("offer_cache.json")
+OFFER_TTL_SEC = int(os.getenv("OFFER_TTL_SEC", "1800"))
+TOKEN_FILE = Path(".amadeus_token.json")
+ALERT_SUPPRESS_SEC = 48 * 3600
 
 def build_session() -> requests.Session:
     s = requests.Session()
@@ -21,7 +29,8 @@ def build_session() -> requests.Session:
         allowed_methods=frozenset(["GET", "POST"]),
         raise_on_status=False,
     )
-    adapter = HTTPAdapter(max_retries=retries)
+    pool = int(os.getenv("HTTP_POOL", "20"))
+    adapter = HTTPAdapter(max_retries=retries, pool_connections=pool, pool_maxsize=pool, pool_block=True)
     s.mount("https://", adapter)
     s.mount("http://", adapter)
     s.headers.update({"User-Agent": "fare-watch/1.0"})
@@ -29,6 +38,20 @@ def build_session() -> requests.Session:
 
 SESSION = build_session()
 
+_THROTTLE_LOCK = threading.Lock()
+_next_slot = 0.0
+
+def throttle(interval: float):
+    """Space out request starts across worker threads to respect the API QPS limit."""
+    global _next_slot
+    with _THROTTLE_LOCK:
+        now = time.monotonic()
+        delay = _next_slot - now
+        _next_slot = max(now, _next_slot) + interval
+    if delay > 0:
+        time.sleep(delay)
+
+@functools.lru_cache(maxsize=None)
 def require_env(name: str) -> str:
     val = os.getenv(name)
     if not val:
@@ -36,16 +59,61 @@ def require_env(name: str) -> str:
         sys.exit(1)
     return val
 
+REQUIRED_ENV = (
+    "AMADEUS_CLIENT_ID", "AMADEUS_CLIENT_SECRET",
+    "SMTP_HOST", "SMTP_PORT", "SMTP_USER", "SMTP_PASS", "RECIPIENT_EMAIL",
+)
+
+def validate_env() -> list[str]:
+    """Fail fast on missing config, before any API quota is spent. Returns the recipient list."""
+    for name in REQUIRED_ENV:
+        require_env(name)
+    try:
+        int(require_env("SMTP_PORT"))
+    except ValueError:
+        print(f"[ERROR] SMTP_PORT is not a number: {require_env('SMTP_PORT')!r}", file=sys.stderr)
+        sys.exit(1)
+    recipients = [r.strip() for r in require_env("RECIPIENT_EMAIL").split(",") if r.strip()]
+    if not recipients:
+        print("[ERROR] RECIPIENT_EMAIL contains no addresses", file=sys.stderr)
+        sys.exit(1)
+    return recipients
+
 def get_token() -> str:
     cid = require_env("AMADEUS_CLIENT_ID")
     secret = require_env("AMADEUS_CLIENT_SECRET")
+    if TOKEN_FILE.exists():
+        try:
+            cached = orjson.loads(TOKEN_FILE.read_bytes())
+            if (cached.get("base") == AMADEUS_BASE and cached.get("client_id") == cid
+                    and cached["expires_at"] - time.time() > 60):
+                return cached["access_token"]
+        except Exception:
+            pass
+
     resp = SESSION.post(
         f"{AMADEUS_BASE}/v1/security/oauth2/token",
         data={"grant_type": "client_credentials", "client_id": cid, "client_secret": secret},
         timeout=(10, 45),
     )
     resp.raise_for_status()
-    return resp.json()["access_token"]
+    data = orjson.loads(resp.content)
+    try:
+        # Create the temp file as 0600 up front so the token is never world-readable
+        tmp = TOKEN_FILE.with_suffix(TOKEN_FILE.suffix + ".tmp")
+        tmp.unlink(missing_ok=True)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps({
+                "access_token": data["access_token"],
+                "expires_at": time.time() + data.get("expires_in", 1799) - 30,
+                "base": AMADEUS_BASE,
+                "client_id": cid,
+            }))
+        os.replace(tmp, TOKEN_FILE)
+    except OSError as e:
+        print(f"[WARN] Could not cache access token: {e}")
+    return data["access_token"]
 
 def inspiration(token: str, origin: str, max_price: int, date_range: str):
     params = {
@@ -60,7 +128,7 @@ def inspiration(token: str, origin: str, max_price: int, date_range: str):
         params=params, timeout=(10, 60)
     )
     r.raise_for_status()
-    return r.json().get("data", [])
+    return orjson.loads(r.content).get("data", [])
 
 def offers(token: str, origin: str, dest: str, dep_date: str, currency: str = "EUR", max_results: int = 3):
     params = {
@@ -77,43 +145,178 @@ def offers(token: str, origin: str, dest: str, dep_date: str, currency: str = "E
         params=params, timeout=(10, 60)
     )
     r.raise_for_status()
-    return r.json().get("data", [])
+    return orjson.loads(r.content).get("data", [])
+
+def fetch_offers(token: str, origin: str, cands, workers: int, interval: float, cache: dict, window: int = 0):
+    """Price (dest, dep) pairs concurrently; yields (cand, result or exception) in input order.
+
+    At most `window` lookups (0 = all) are submitted ahead of the consumer, and closing
+    the generator early stops further submissions.
+    """
+    def fetch(dest: str, dep: str):
+        key = f"{AMADEUS_BASE}:{origin}:{dest}:{dep}:EUR:3"
+        entry = cache.get(key)
+        if entry and time.time() - entry["ts"] < OFFER_TTL_SEC:
+            return entry["data"]
+        throttle(interval)
+        data = offers(token, origin, dest, dep, currency="EUR", max_results=3)
+        cache[key] = {"ts": time.time(), "data": data}
+        return data
+
+    todo = iter(cands)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        try:
+            for cand in itertools.islice(todo, window or None):
+                pending.append((cand, ex.submit(fetch, *cand)))
+            while pending:
+                cand, fut = pending.popleft()
+                nxt = next(todo, None)
+                if nxt is not None:
+                    pending.append((nxt, ex.submit(fetch, *nxt)))
+                yield cand, fut.exception() or fut.result()
+        finally:
+            for _, fut in pending:
+                fut.cancel()
 
-def send_email(subject: str, html_body: str):
+def send_email(subject: str, html_body: str, recipients: list[str]):
     host = require_env("SMTP_HOST")
     port = int(require_env("SMTP_PORT"))
     user = require_env("SMTP_USER")
     password = require_env("SMTP_PASS")
-    recipient = require_env("RECIPIENT_EMAIL")
 
     msg = MIMEText(html_body, "html", "utf-8")
     msg["Subject"] = subject
     msg["From"] = user
-    msg["To"] = recipient
 
     context = ssl.create_default_context()
     try:
-        with smtplib.SMTP(host, port, timeout=30) as server:
-            server.ehlo()
-            server.starttls(context=context)
+        # Port 465 is implicit TLS: one handshake, no EHLO/STARTTLS/EHLO dance
+        if port == 465:
+            server = smtplib.SMTP_SSL(host, port, timeout=30, context=context)
+        else:
+            server = smtplib.SMTP(host, port, timeout=30)
+        with server:
+            if port != 465:
+                server.ehlo()
+                server.starttls(context=context)
             server.login(user, password)
-            server.send_message(msg)
+            for rcpt in recipients:
+                del msg["To"]
+                msg["To"] = rcpt
+                server.send_message(msg)
         print("[INFO] Email sent successfully.")
     except Exception as e:
         print(f"[ERROR] Failed to send email: {e}")
 
-def load_state():
-    if STATE_FILE.exists():
+def _import_legacy_state(db: sqlite3.Connection):
+    """One-time import of alert keys like "BER-BCN-2025-09-14-79" from state.json."""
+    try:
+        alerts = orjson.loads(LEGACY_STATE_FILE.read_bytes()).get("alerts") or {}
+    except Exception:
+        return
+    rows = []
+    for key, ts in alerts.items():
+        parts = key.split("-")
+        if len(parts) != 6:
+            continue
+        origin, dest, y, m, d, price = parts
         try:
-            return json.loads(STATE_FILE.read_text())
-        except Exception:
-            return {"alerts": {}}
-    return {"alerts": {}}
+            ts = float(ts)
+            price = int(price)
+        except (TypeError, ValueError):
+            continue
+        rows.append((origin, dest, f"{y}-{m}-{d}", price, ts))
+    db.executemany("INSERT OR REPLACE INTO alerts VALUES (?, ?, ?, ?, ?)", rows)
+    db.commit()
+    LEGACY_STATE_FILE.unlink()
 
-def save_state(state):
-    STATE_FILE.write_text(json.dumps(state, indent=2))
+def _open_state_db() -> sqlite3.Connection:
+    db = sqlite3.connect(STATE_DB)
+    try:
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS alerts("
+            "origin TEXT, dest TEXT, dep TEXT, price INTEGER, ts REAL, "
+            "PRIMARY KEY(origin, dest, dep, price))"
+        )
+    except sqlite3.DatabaseError:
+        db.close()
+        raise
+    return db
+
+def load_state() -> sqlite3.Connection:
+    fresh = not STATE_DB.exists()
+    try:
+        db = _open_state_db()
+    except sqlite3.DatabaseError as e:
+        corrupt = STATE_DB.with_suffix(STATE_DB.suffix + ".corrupt")
+        print(f"[WARN] {STATE_DB} is unreadable ({e}); moving it to {corrupt} and starting fresh")
+        os.replace(STATE_DB, corrupt)
+        for suffix in ("-wal", "-shm"):
+            Path(f"{STATE_DB}{suffix}").unlink(missing_ok=True)
+        db = _open_state_db()
+    if fresh and LEGACY_STATE_FILE.exists():
+        _import_legacy_state(db)
+    # Alerts past the suppression window can never block a resend, so drop them
+    db.execute("DELETE FROM alerts WHERE ts <= ?", (time.time() - ALERT_SUPPRESS_SEC,))
+    return db
+
+def last_alert(db: sqlite3.Connection, origin: str, dest: str, dep: str, price: int) -> float:
+    row = db.execute(
+        "SELECT ts FROM alerts WHERE origin=? AND dest=? AND dep=? AND price=?",
+        (origin, dest, dep, price),
+    ).fetchone()
+    return row[0] if row else 0
+
+def record_alert(db: sqlite3.Connection, origin: str, dest: str, dep: str, price: int, ts: float):
+    db.execute("INSERT OR REPLACE INTO alerts VALUES (?, ?, ?, ?, ?)", (origin, dest, dep, price, ts))
+
+def atomic_write(path: Path, data: bytes):
+    """Write via a fsynced temp file and os.replace, so a crash never leaves a torn file."""
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def save_state(db: sqlite3.Connection):
+    try:
+        db.commit()
+    except sqlite3.Error as e:
+        print(f"[ERROR] Failed to save state: {e}")
+    finally:
+        db.close()
+
+def load_offer_cache():
+    if not OFFER_CACHE_FILE.exists():
+        return {}
+    try:
+        cache = orjson.loads(OFFER_CACHE_FILE.read_bytes())
+    except Exception:
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    # Keep only well-formed entries so a hand-edited or stale-format file can't crash the run
+    return {
+        k: v for k, v in cache.items()
+        if isinstance(v, dict)
+        and isinstance(v.get("ts"), (int, float)) and not isinstance(v.get("ts"), bool)
+        and isinstance(v.get("data"), list)
+    }
+
+def save_offer_cache(cache):
+    cutoff = time.time() - OFFER_TTL_SEC
+    fresh = {k: v for k, v in cache.items() if v["ts"] >= cutoff}
+    try:
+        atomic_write(OFFER_CACHE_FILE, orjson.dumps(fresh))
+    except OSError as e:
+        print(f"[WARN] Failed to save offer cache: {e}")
 
 def main():
+    recipients = validate_env()
     origin = os.getenv("ORIGIN", "BER")
     max_price = int(os.getenv("MAX_PRICE_EUR", "80"))
     days_ahead = int(os.getenv("DAYS_AHEAD", "180"))
@@ -130,61 +333,84 @@ def main():
     insp = inspiration(token, origin, max_price, date_range)
     print(f"[INFO] Inspiration candidates: {len(insp)}")
 
-    # Sort inspiration candidates by price
+    # Sort inspiration candidates by indicative price, cheapest first
     insp_sorted = sorted(
         [it for it in insp if "price" in it and "total" in it["price"]],
         key=lambda x: float(x["price"]["total"])
     )
 
-    state = load_state()
+    db = load_state()
     alerts = []
+    workers = int(os.getenv("OFFERS_CONCURRENCY", "6"))
+    now = time.time
+    suppress_window = ALERT_SUPPRESS_SEC
+    fields = ("destination", "departureDate")
 
+    cands = []
     for it in insp_sorted[:max_candidates]:
-        dest = it.get("destination")
-        dep = it.get("departureDate")
+        dest, dep = map(it.get, fields)
         if not (dest and dep):
             print(f"[SKIP] Missing destination or departure date in candidate: {it}")
             continue
+        cands.append((dest, dep))
 
-        try:
-            live = offers(token, origin, dest, dep, currency="EUR", max_results=3)
-        except requests.exceptions.RequestException as e:
-            print(f"[SKIP] Offers failed for {origin}-{dest} on {dep}: {e}")
+    # Candidates are priced cheapest-indicative first. With MAX_MISS_STREAK set, only `workers`
+    # lookups run ahead of processing, so a run of over-cap prices stops further API calls
+    max_misses = int(os.getenv("MAX_MISS_STREAK", "0"))
+    misses = 0
+    offer_cache = load_offer_cache()
+    results = fetch_offers(token, origin, cands, workers, sleep_ms / 1000.0, offer_cache,
+                           window=workers if max_misses else 0)
+    for n, ((dest, dep), live) in enumerate(results):
+        if isinstance(live, (requests.exceptions.RequestException, orjson.JSONDecodeError)):
+            print(f"[SKIP] Offers failed for {origin}-{dest} on {dep}: {live}")
             continue
+        if isinstance(live, BaseException):
+            raise live
 
         if not live:
             print(f"[SKIP] No live offers returned for {origin}-{dest} on {dep}")
-            time.sleep(sleep_ms / 1000.0)
             continue
 
         try:
             live_total = float(live[0]["price"]["grandTotal"])
         except Exception as e:
             print(f"[SKIP] Failed to parse price for {origin}-{dest} on {dep}: {e}")
-            time.sleep(sleep_ms / 1000.0)
             continue
-        if live_total <= max_price:
-            key = f"{origin}-{dest}-{dep}-{int(live_total)}"
-            last = state["alerts"].get(key, 0)
-            if time.time() - last < 48 * 3600:
-                print(f"[SKIP] Duplicate alert for {key} (sent recently)")
-                continue
-
-            html = (
-                f"<p>✈️ <b>{origin}</b> → <b>{dest}</b><br>"
-                f"<b>Date:</b> {dep}<br>"
-                f"<b>Price:</b> {live_total:.0f} €</p>"
-            )
-            alerts.append((live_total, html))
-            state["alerts"][key] = time.time()
-
-        time.sleep(sleep_ms / 1000.0)
+        if live_total > max_price:
+            misses += 1
+            if max_misses and misses >= max_misses:
+                skipped = cands[n + 1:]
+                if skipped:
+                    print(f"[INFO] {misses} consecutive candidates over the cap; not checking {len(skipped)} remaining: "
+                          + ", ".join(f"{s_dest} on {s_dep}" for s_dest, s_dep in skipped))
+                break
+            continue
+
+        misses = 0
+        price = int(live_total)
+        key = f"{origin}-{dest}-{dep}-{price}"
+        last = last_alert(db, origin, dest, dep, price)
+        if now() - last < suppress_window:
+            print(f"[SKIP] Duplicate alert for {key} (sent recently)")
+            continue
+
+        html = (
+            f"<p>✈️ <b>{origin}</b> → <b>{dest}</b><br>"
+            f"<b>Date:</b> {dep}<br>"
+            f"<b>Price:</b> {live_total:.0f} €</p>"
+        )
+        alerts.append((live_total, html))
+        record_alert(db, origin, dest, dep, price, now())
+
+    results.close()
+    save_offer_cache(offer_cache)
 
     # Sort alerts by price and keep only the 5 cheapest
     alerts_sorted = sorted(alerts, key=lambda x: x[0])[:5]
     if alerts_sorted:
         body = "<h3>Top 5 one-way fare(s) under your cap</h3>" + "<hr/>".join([html for _, html in alerts_sorted])
-        send_email("Top 5 one-way fare(s) under your cap", body)
-        save_state(state)
+        send_email("Top 5 one-way fare(s) under your cap", body, recipients)
+    save_state(db)
 
 main()